@@ -1,13 +1,22 @@
 import streamlit as st
-import PyPDF2
+import asyncio
+import fitz  # PyMuPDF
 import re
-import pyttsx3
 import threading
 import time
 import json
-from typing import List, Tuple
+import logging
+import random
+import io
+import queue
+import os
+import hashlib
+import tempfile
+import concurrent.futures
+import contextlib
+import collections
+from typing import Iterator, List, Optional, Tuple
 from gtts import gTTS
-import tempfile 
 
 # Optional libraries for OCR
 try:
@@ -16,11 +25,24 @@ try:
 except ImportError:
     st.warning("To enable OCR for scanned PDFs, please install 'pdf2image' and 'pytesseract' libraries.")
 
+# Optional image preprocessing for OCR (binarized pages OCR faster and more accurately)
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+# Optional linear-time regex engine for document search (from 'google-re2' package)
+try:
+    import re2 as search_re
+except ImportError:
+    search_re = re
+
 # For WebSocket client functionality
 try:
-    import websocket  # from 'websocket-client' package
+    import websockets  # asyncio client, same package as ws_server.py
 except ImportError:
-    st.warning("To enable real-time collaboration, please install the 'websocket-client' package.")
+    st.warning("To enable real-time collaboration, please install the 'websockets' package.")
 
 # For OpenAI API (ensure you have openai installed and your API key configured)
 try:
@@ -28,79 +50,201 @@ try:
 except ImportError:
     st.warning("To enable AI summarization and Q&A, please install the 'openai' package.")
 
+logger = logging.getLogger(__name__)
+
 # ------------------------------
 # Helper Functions
 # ------------------------------
 
 
 
-def extract_pdf_text(file) -> Tuple[List[str], bool]:
+def _preprocess_for_ocr(image):
+    """Convert a page image to grayscale and binarize it with adaptive thresholding."""
+    if cv2 is None:
+        return image
+    gray = cv2.cvtColor(np.array(image.convert("RGB")), cv2.COLOR_RGB2GRAY)
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+
+# OCR output cached by a hash of the rendered page image, shared across documents and sessions
+OCR_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pdfbot", "ocr")
+OCR_MEMORY_CACHE_SIZE = 256
+
+@st.cache_resource
+def _get_ocr_memory_cache() -> Tuple[collections.OrderedDict, threading.Lock]:
+    """In-memory LRU of OCR results ({image hash: text}, least recently used first) that survives reruns."""
+    return collections.OrderedDict(), threading.Lock()
+
+def _ocr_image_cached(image) -> str:
     """
-    Extract text from a PDF file.
-    If the page text is empty, try using OCR to extract text from the page image.
-    Returns a tuple (list of page texts, success flag).
+    Run OCR on a page image, reusing a previous result for an identical image.
+    Looks in a small in-memory LRU first, then on disk in OCR_CACHE_DIR.
     """
+    # Mode and size are part of the key: different renders can share the same raw pixel bytes
+    digest = hashlib.blake2b(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode(), digest_size=16)
+    digest.update(image.tobytes())
+    key = digest.hexdigest()
+    memory_cache, lock = _get_ocr_memory_cache()
+    with lock:
+        if key in memory_cache:
+            memory_cache.move_to_end(key)
+            return memory_cache[key]
+
+    path = os.path.join(OCR_CACHE_DIR, f"{key}.txt")
     try:
-        reader = PyPDF2.PdfReader(file)
-        pages_text = []
-        
-        # Read file bytes for OCR conversion
-        file.seek(0)
-        file_bytes = file.read()
-        file.seek(0)  # Reset pointer for PyPDF2
-        
-        # Try to convert PDF pages to images for OCR if available
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    except OSError:
+        text = pytesseract.image_to_string(_preprocess_for_ocr(image), config="--oem 1")
         try:
-            images = convert_from_bytes(file_bytes)
-        except Exception as e:
-            images = []
-            st.warning("OCR conversion failed; make sure Poppler is installed properly.")
-        
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text()
-            if not text or not text.strip():
-                # If text extraction failed, try OCR if we have an image
-                if images and i < len(images):
-                    try:
-                        text = pytesseract.image_to_string(images[i])
-                        if not text.strip():
-                            text = f"Page {i+1} has no extractable text."
-                    except Exception as e:
-                        text = f"Error during OCR on Page {i+1}: {str(e)}"
-                else:
-                    text = f"Page {i+1} has no extractable text."
-            pages_text.append(text)
-        return pages_text, True
+            os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+            # Write to a temp file and rename so concurrent readers never see a partial file
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=OCR_CACHE_DIR,
+                                             suffix=".tmp", delete=False) as f:
+                f.write(text)
+            os.replace(f.name, path)
+        except OSError:
+            pass  # The disk cache is best-effort
+
+    with lock:
+        memory_cache[key] = text
+        if len(memory_cache) > OCR_MEMORY_CACHE_SIZE:
+            memory_cache.popitem(last=False)
+    return text
+
+def _ocr_page(file_bytes: bytes, page_index: int) -> Optional[str]:
+    """
+    Render a single PDF page and run OCR on it.
+    Returns None if the page could not be rasterized (e.g. Poppler is missing).
+    """
+    try:
+        images = convert_from_bytes(file_bytes, first_page=page_index+1, last_page=page_index+1, dpi=200)
+    except Exception:
+        return None
+    if not images:
+        return None
+    return _ocr_image_cached(images[0])
+
+def iter_pdf_text(file_bytes: bytes, extraction: dict) -> Iterator[Tuple[int, str]]:
+    """
+    Extract text from the raw bytes of a PDF file, yielding (page index, text) in page order.
+    If the page text is empty, try using OCR to extract text from the page image.
+    Sets extraction["page_count"] up front and extraction["rasterize_failed"] if OCR could not render a page.
+    """
+    doc = fitz.open(stream=file_bytes, filetype="pdf")
+    pages_text = [page.get_text("text") for page in doc]
+    doc.close()
+    extraction["page_count"] = len(pages_text)
+
+    # Text extraction failed on these pages; queue them for OCR
+    ocr_pages = [i for i, text in enumerate(pages_text) if not text or not text.strip()]
+
+    # Tesseract runs as a subprocess, so threads OCR pages in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futures = {i: ex.submit(_ocr_page, file_bytes, i) for i in ocr_pages}
+        for i, text in enumerate(pages_text):
+            if i in futures:
+                try:
+                    text = futures[i].result()
+                    if text is None:
+                        extraction["rasterize_failed"] = True
+                        text = f"Page {i+1} has no extractable text."
+                    elif not text.strip():
+                        text = f"Page {i+1} has no extractable text."
+                except Exception as e:
+                    text = f"Error during OCR on Page {i+1}: {str(e)}"
+            yield i, text
+
+def _fill_pdf_extraction(file_bytes: bytes, extraction: dict):
+    """Background thread function that appends pages to the extraction as they are ready."""
+    try:
+        for _, text in iter_pdf_text(file_bytes, extraction):
+            extraction["pages"].append(text)
+        # Derived text is built once here and shared by every session viewing this document
+        extraction["full_text"] = "\n".join(extraction["pages"])
+        extraction["pages_lower"] = tuple(page.lower() for page in extraction["pages"])
     except Exception as e:
-        st.error(f"PDF Error: {str(e)}")
-        return [f"Error processing PDF: {str(e)}"], False
+        extraction["error"] = str(e)
+    finally:
+        extraction["done"].set()
+
+@st.cache_resource(show_spinner=False, max_entries=8, ttl=3600)
+def get_pdf_extraction(doc_id: str, _file_bytes: bytes) -> dict:
+    """
+    Start extracting a PDF in a background thread and return its shared extraction state:
+    {"pages": [...], "page_count": int, "done": Event, "error": str, "rasterize_failed": bool,
+     "full_text": str, "pages_lower": tuple} (the last two are set once extraction finishes).
+    Cached on the document hash so reruns and other sessions reuse the same extraction.
+    """
+    extraction = {
+        "pages": [],
+        "page_count": None,
+        "done": threading.Event(),
+        "error": None,
+        "rasterize_failed": False,
+        "full_text": None,
+        "pages_lower": None,
+    }
+    threading.Thread(target=_fill_pdf_extraction, args=(_file_bytes, extraction), daemon=True).start()
+    return extraction
+
+@st.cache_resource
+def get_translator():
+    """Create the googletrans client once and reuse it across reruns."""
+    from googletrans import Translator
+    return Translator()
+
+@st.cache_data(show_spinner=False, ttl=86400)
+def _translate_text_cached(text: str, dest_lang: str) -> str:
+    """Cached translation keyed on (text, language); failures raise and are not cached."""
+    return get_translator().translate(text, dest=dest_lang).text
 
 def translate_text(text: str, dest_lang: str) -> str:
     """Translate text to the target language synchronously."""
     try:
-        from googletrans import Translator
-        translator = Translator()
-        translated = translator.translate(text, dest=dest_lang)
-        return translated.text
+        return _translate_text_cached(text, dest_lang)
     except Exception as e:
         st.error(f"Translation Error: {str(e)}")
         return text
 
-def text_to_speech(text):
-    """Convert text to speech and return the audio file path."""
+@st.cache_data(show_spinner=False, max_entries=64)
+def text_to_speech(text: str) -> bytes:
+    """Convert text to speech and return the MP3 audio bytes. Cached per text."""
     tts = gTTS(text=text, lang="en")
     
-    # Save audio in a temporary file
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-    tts.save(temp_file.name)
+    # Render the audio in memory instead of a temporary file
+    audio = io.BytesIO()
+    tts.write_to_fp(audio)
     
-    return temp_file.name
+    return audio.getvalue()
+
+def _request_summary(text: str) -> str:
+    """Ask the OpenAI API for a concise summary of the text. Raises on API errors."""
+    # Using GPT-3.5 Turbo for summarization
+    response = openai.ChatCompletion.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant that summarizes text concisely."},
+            {"role": "user", "content": f"Summarize the following text:\n\n{text}"}
+        ],
+        max_tokens=150,
+        temperature=0.5,
+    )
+    return response["choices"][0]["message"]["content"].strip()
+
+@st.cache_data(show_spinner=False, max_entries=256, ttl=86400)
+def _summarize_text_cached(text: str) -> str:
+    """Cached summary keyed on the text itself; failures raise and are not cached."""
+    return _request_summary(text)
 
 def summarize_text(text: str) -> str:
     """
     Use the OpenAI API to summarize the provided text.
     Make sure your API key is set in Streamlit secrets as OPENAI_API_KEY.
     """
+    # Nothing worth summarizing; skip the API call
+    if len(text.strip()) < 40:
+        return text
+
     openai_api_key = st.secrets.get("OPENAI_API_KEY", None)
     if not openai_api_key:
         st.error("OpenAI API key not found in secrets. Please add it as OPENAI_API_KEY.")
@@ -108,17 +252,110 @@ def summarize_text(text: str) -> str:
     
     openai.api_key = openai_api_key
     try:
-        # Using GPT-3.5 Turbo for summarization
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that summarizes text concisely."},
-                {"role": "user", "content": f"Summarize the following text:\n\n{text}"}
-            ],
-            max_tokens=150,
-            temperature=0.5,
-        )
-        summary = response["choices"][0]["message"]["content"].strip()
+        return _summarize_text_cached(text)
+    except Exception as e:
+        st.error(f"Error during summarization: {e}")
+        return "Summarization failed."
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def run_search(doc_id: str, _pdf_pages: Tuple[str, ...], _pdf_pages_lower: Tuple[str, ...],
+               term: str) -> List[Tuple[int, str, int, int]]:
+    """
+    Search every page for a term (case-insensitive).
+    Cached on (doc_id, term); the page tuples are not hashed since doc_id identifies them.
+    Returns a list of (page number, context slice, match start, match end) where the
+    match offsets are relative to the context slice.
+    """
+    matches = []
+    # Inline (?i) flag so the same pattern works with both re2 and re
+    pattern = search_re.compile("(?i)" + re.escape(term))
+    term_lower = term.lower()
+    for page_num, text in enumerate(_pdf_pages):
+        # Cheap substring check skips pages without the term before running the regex
+        if term_lower not in _pdf_pages_lower[page_num]:
+            continue
+        text_len = len(text)
+        # Single regex pass per page; the highlight is applied later by slicing at the match offsets
+        for match in pattern.finditer(text):
+            match_start, match_end = match.span()
+            # Extract context around the match (up to 100 characters on either side)
+            start_context = max(0, match_start - 100)
+            end_context = min(text_len, match_end + 100)
+            matches.append((page_num + 1, text[start_context:end_context],
+                            match_start - start_context, match_end - start_context))
+    return matches
+
+# Roughly 3k tokens of document text per map request
+SUMMARY_CHUNK_CHARS = 12000
+
+def _chunk_pages(pages: Tuple[str, ...], max_chars: int = SUMMARY_CHUNK_CHARS) -> List[str]:
+    """Group consecutive pages into chunks of at most max_chars characters."""
+    chunks, current, size = [], [], 0
+    for page in pages:
+        # Split oversized pages so no single chunk exceeds the limit
+        for start in range(0, max(len(page), 1), max_chars):
+            piece = page[start:start + max_chars]
+            if current and size + len(piece) > max_chars:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece)
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def _summarize_document_chunks(doc_id: str, _pdf_pages: Tuple[str, ...]) -> List[str]:
+    """Summarize every chunk of the document in parallel. Cached per document."""
+    chunks = _chunk_pages(_pdf_pages)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as ex:
+        return list(ex.map(_request_summary, chunks))
+
+def _stream_combined_summary(summaries: List[str]):
+    """Combine the partial summaries into one (reduce step), yielding tokens as they arrive."""
+    response = openai.ChatCompletion.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant that summarizes text concisely."},
+            {"role": "user", "content": "Combine the following partial summaries of one document into a single concise summary:\n\n"
+                                        + "\n\n".join(summaries)}
+        ],
+        max_tokens=250,
+        temperature=0.5,
+        stream=True,
+    )
+    for chunk in response:
+        content = chunk["choices"][0]["delta"].get("content")
+        if content:
+            yield content
+
+def summarize_document(doc_id: str, pdf_pages: Tuple[str, ...]) -> str:
+    """
+    Summarize the entire document with a map-reduce over page chunks and
+    stream the final summary to the page.
+    Results are kept in session state so repeated clicks don't hit the API again.
+    """
+    if "document_summaries" not in st.session_state:
+        st.session_state.document_summaries = {}
+    if doc_id in st.session_state.document_summaries:
+        summary = st.session_state.document_summaries[doc_id]
+        st.write(summary)
+        return summary
+
+    openai_api_key = st.secrets.get("OPENAI_API_KEY", None)
+    if not openai_api_key:
+        st.error("OpenAI API key not found in secrets. Please add it as OPENAI_API_KEY.")
+        return "Summarization unavailable."
+    
+    openai.api_key = openai_api_key
+    try:
+        summaries = _summarize_document_chunks(doc_id, pdf_pages)
+        if len(summaries) == 1:
+            summary = summaries[0]
+            st.write(summary)
+        else:
+            summary = st.write_stream(_stream_combined_summary(summaries))
+        st.session_state.document_summaries[doc_id] = summary
         return summary
     except Exception as e:
         st.error(f"Error during summarization: {e}")
@@ -200,42 +437,201 @@ def generate_quiz(text: str, num_questions: int = 5) -> str:
 
 WS_SERVER_URL = "ws://localhost:6789"
 
-def on_message(ws, message):
-    """Callback when a message is received from the WebSocket server."""
-    try:
-        data = json.loads(message)
-        # Append the received annotation or chat message to the shared session state list.
-        if data.get("type") == "annotation":
-            if "collab_annotations" not in st.session_state:
-                st.session_state.collab_annotations = []
-            st.session_state.collab_annotations.append(data)
-        elif data.get("type") == "chat":
-            if "collab_chat" not in st.session_state:
-                st.session_state.collab_chat = []
-            st.session_state.collab_chat.append(data)
-        st.rerun()  # Use st.rerun to update the UI
-    except Exception as e:
-        st.error(f"Error processing collaborative message: {e}")
+# Incoming messages trigger at most one rerun per WS_RERUN_INTERVAL,
+# and only after no new message has arrived for WS_RERUN_IDLE seconds
+WS_RERUN_INTERVAL = 0.1
+WS_RERUN_IDLE = 0.05
+
+def _chat_key(item: dict) -> tuple:
+    """Identify a chat message so replays after a resync are not shown twice."""
+    return (item.get("user"), item.get("timestamp"), item.get("message"))
+
+def handle_ws_message(client: dict, message: str):
+    """Store a received annotation or chat message in the session's collaboration state."""
+    data = json.loads(message)
+    # Senders coalesce messages into {"batch": [...]} frames
+    for item in data.get("batch", [data]):
+        if item.get("type") == "annotation":
+            # This session's own annotation echoed back by a peer's resync reply
+            if item.get("id") in client["sent"]:
+                continue
+            # Keyed by annotation id so duplicate deliveries overwrite instead of piling up
+            client["annotations"][item.get("id") or json.dumps(item, sort_keys=True)] = item
+        elif item.get("type") == "chat":
+            key = _chat_key(item)
+            if key in client["chat_seen"]:
+                continue
+            client["chat_seen"].add(key)
+            client["chat"].append(item)
+        elif item.get("type") == "resync":
+            # A peer reconnected; replay this session's own messages newer than the last event it saw.
+            # Every peer answers for itself, so relaying what others sent would only multiply traffic
+            since = item.get("since", 0.0)
+            for payload in list(client["sent"].values()):
+                if payload.get("timestamp", 0.0) > since:
+                    client["outbox"].put(payload)
+            continue
+        client["last_event_ts"] = max(client["last_event_ts"], item.get("timestamp", 0.0))
+    # Mark the UI stale; poll_collab_updates triggers a single rerun once the burst settles
+    client["dirty"] = True
+    client["last_msg_ts"] = time.monotonic()
+
+@st.experimental_fragment(run_every=WS_RERUN_INTERVAL)
+def poll_collab_updates():
+    """
+    Fragment that checks for collaborative messages every WS_RERUN_INTERVAL and triggers
+    a single full rerun once a burst has settled for WS_RERUN_IDLE seconds.
+    Runs in the session's own current script context, so the rerun works even when idle.
+    """
+    client = st.session_state.get("ws_client")
+    if client is None:
+        return
+    # Heartbeat: shows the client task that this session's page is still open
+    client["last_seen"] = time.monotonic()
+    if not client["dirty"]:
+        return
+    if time.monotonic() - client["last_msg_ts"] < WS_RERUN_IDLE:
+        return
+    client["dirty"] = False
+    st.rerun()  # Use st.rerun to update the UI
+
+# Outgoing messages are coalesced and flushed at most this often
+WS_FLUSH_INTERVAL = 0.02
+
+async def flush_outbox(ws, client: dict):
+    """
+    Drain the outbox every WS_FLUSH_INTERVAL and send everything queued as a single batch frame.
+    A batch that fails to send is kept in client["pending"] and goes out first on the next connection.
+    """
+    while True:
+        await asyncio.sleep(WS_FLUSH_INTERVAL)
+        batch, client["pending"] = client["pending"], []
+        while True:
+            try:
+                batch.append(client["outbox"].get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            continue
+        try:
+            await ws.send(json.dumps({"batch": batch}))
+        except BaseException:
+            client["pending"] = batch
+            raise
+
+# Keepalive pings detect dead connections; reconnects back off exponentially up to WS_MAX_BACKOFF
+WS_PING_INTERVAL = 20
+WS_PING_TIMEOUT = 10
+WS_MAX_BACKOFF = 30
+# A connection that stayed up this long resets the backoff
+WS_STABLE_UPTIME = 60
 
-def on_error(ws, error):
-    st.error(f"WebSocket error: {error}")
+# The client task stops once its page has sent no heartbeat for this long. Generous enough
+# to ride out network blips and browsers throttling timers in background tabs; a session
+# that comes back later simply gets a new client task on its next rerun
+WS_SESSION_TIMEOUT = 300
 
-def on_close(ws, close_status_code, close_msg):
-    st.info("WebSocket connection closed.")
+async def _watch_session(client: dict, task: asyncio.Task):
+    """Cancel the session's client task once the page has stopped sending heartbeats."""
+    while time.monotonic() - client["last_seen"] < WS_SESSION_TIMEOUT:
+        await asyncio.sleep(WS_SESSION_TIMEOUT / 10)
+    task.cancel()
 
-def websocket_listen():
-    """Background thread function to connect and listen to the WebSocket server."""
-    ws = websocket.WebSocketApp(WS_SERVER_URL,
-                                on_message=on_message,
-                                on_error=on_error,
-                                on_close=on_close)
-    ws.run_forever()
+async def ws_client_task(client: dict):
+    """
+    Connect to the WebSocket server, flush outgoing batches and handle incoming messages.
+    Reconnects with jittered exponential backoff and asks peers to resync after each reconnect.
+    Runs until the session's page stops sending heartbeats.
+    """
+    watchdog = asyncio.create_task(_watch_session(client, asyncio.current_task()))
+    try:
+        await _run_ws_client(client)
+    finally:
+        watchdog.cancel()
+
+async def _run_ws_client(client: dict):
+    """Connection loop of ws_client_task."""
+    attempt = 0
+    while True:
+        connected_at = None
+        try:
+            async with websockets.connect(WS_SERVER_URL, ping_interval=WS_PING_INTERVAL,
+                                          ping_timeout=WS_PING_TIMEOUT) as ws:
+                connected_at = time.monotonic()
+                # Ask peers for anything sent while this client was disconnected
+                client["outbox"].put({"type": "resync", "since": client["last_event_ts"]})
+                flusher = asyncio.create_task(flush_outbox(ws, client))
+                try:
+                    async for message in ws:
+                        try:
+                            handle_ws_message(client, message)
+                        except Exception:
+                            logger.exception("Error processing collaborative message")
+                finally:
+                    flusher.cancel()
+                    # Retrieve the flusher's outcome; a failed send already left its batch pending
+                    with contextlib.suppress(asyncio.CancelledError, websockets.exceptions.ConnectionClosed):
+                        await flusher
+        except Exception as e:
+            logger.warning("WebSocket error: %s", e)
+        if connected_at is not None and time.monotonic() - connected_at >= WS_STABLE_UPTIME:
+            attempt = 0
+        await asyncio.sleep(min(WS_MAX_BACKOFF, 0.5 * 2 ** attempt) + random.uniform(0, 0.5))
+        attempt += 1
+
+@st.cache_resource
+def get_ws_loop() -> asyncio.AbstractEventLoop:
+    """Start the background event loop that runs every session's WebSocket client."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
 
 def start_ws_client():
-    """Start the WebSocket client thread if not already started."""
-    if "ws_client_started" not in st.session_state:
-        st.session_state.ws_client_started = True
-        threading.Thread(target=websocket_listen, daemon=True).start()
+    """Start the WebSocket client on the shared event loop if it is not already running."""
+    if "collab_annotations" not in st.session_state:
+        st.session_state.collab_annotations = {}
+    if "collab_chat" not in st.session_state:
+        st.session_state.collab_chat = []
+    if "ws_client" not in st.session_state:
+        # A client task left over from an earlier state would otherwise keep running unowned
+        if st.session_state.get("ws_future") is not None:
+            st.session_state.ws_future.cancel()
+            st.session_state.ws_future = None
+        # Plain objects shared with the event loop, which has no access to session state;
+        # the annotation dict and chat list are the same objects the UI renders
+        st.session_state.ws_client = {
+            "annotations": st.session_state.collab_annotations,
+            "chat": st.session_state.collab_chat,
+            "chat_seen": {_chat_key(item) for item in st.session_state.collab_chat},
+            "sent": {},  # This session's own annotations (by id) and chat messages (by _chat_key), replayed on resync
+            "outbox": queue.Queue(),
+            "pending": [],  # Batch that failed to send; sent ahead of the outbox on reconnect
+            "dirty": False,
+            "last_msg_ts": 0.0,
+            "last_event_ts": 0.0,
+            "last_seen": time.monotonic(),  # Heartbeat from this session's page
+        }
+    st.session_state.ws_client["last_seen"] = time.monotonic()
+    future = st.session_state.get("ws_future")
+    if future is None or future.done():
+        if future is not None and not future.cancelled() and future.exception() is not None:
+            st.warning(f"WebSocket error: {future.exception()}")
+        st.session_state.ws_future = asyncio.run_coroutine_threadsafe(
+            ws_client_task(st.session_state.ws_client), get_ws_loop())
+
+def send_ws_message(payload: dict):
+    """
+    Queue a payload to be sent in the next batch over the WebSocket connection.
+    Restarts the client first if its connection has ended.
+    """
+    start_ws_client()
+    client = st.session_state.ws_client
+    if payload.get("type") == "annotation":
+        client["sent"][payload["id"]] = payload
+    elif payload.get("type") == "chat":
+        client["chat_seen"].add(_chat_key(payload))
+        client["sent"][_chat_key(payload)] = payload
+    client["outbox"].put(payload)
 
 # ------------------------------
 # Streamlit UI Configuration
@@ -279,61 +675,99 @@ with st.sidebar:
 # Conditional CSS Styling for Dark and Light Modes
 # ------------------------------
 
-if dark_mode:
-    background_color = "#1a1a1a"
-    text_color = "#ffffff"
-    header_color = "#ecf0f1"
-    button_bg = "#4CAF50"
-    button_hover = "#45a049"
-else:
-    background_color = "#f8f9fa"
-    text_color = "#000000"
-    header_color = "#2c3e50"
-    button_bg = "#4CAF50"
-    button_hover = "#45a049"
+# Both stylesheets are plain string constants, so a rerun only picks one instead of formatting CSS
+_CSS_DARK = """
+    <style>
+        .main {
+            background-color: #1a1a1a;
+            color: #ffffff;
+            padding: 2rem;
+        }
+        [data-testid="stMarkdownContainer"] * {
+            color: #ffffff !important;
+        }
+        textarea {
+            color: #ffffff !important;
+            background-color: #1a1a1a !important;
+            border: 1px solid #ccc !important;
+        }
+        .stButton>button {
+            background-color: #4CAF50;
+            color: white;
+            border-radius: 8px;
+            padding: 12px 24px;
+            transition: transform 0.2s;
+        }
+        .stButton>button:hover {
+            transform: scale(1.05);
+            background-color: #45a049;
+        }
+        .stDownloadButton>button {
+            background-color: #008CBA !important;
+        }
+        .highlight {
+            background-color: #ffff00;
+            padding: 2px 4px;
+            border-radius: 4px;
+        }
+        /* Header styling */
+        .header {
+            text-align: center;
+            padding: 2rem 0;
+        }
+    </style>
+"""
 
-custom_css = f"""
+_CSS_LIGHT = """
     <style>
-        .main {{
-            background-color: {background_color};
-            color: {text_color};
+        .main {
+            background-color: #f8f9fa;
+            color: #000000;
             padding: 2rem;
-        }}
-        [data-testid="stMarkdownContainer"] * {{
-            color: {text_color} !important;
-        }}
-        textarea {{
-            color: {text_color} !important;
-            background-color: {background_color} !important;
+        }
+        [data-testid="stMarkdownContainer"] * {
+            color: #000000 !important;
+        }
+        textarea {
+            color: #000000 !important;
+            background-color: #f8f9fa !important;
             border: 1px solid #ccc !important;
-        }}
-        .stButton>button {{
-            background-color: {button_bg};
+        }
+        .stButton>button {
+            background-color: #4CAF50;
             color: white;
             border-radius: 8px;
             padding: 12px 24px;
             transition: transform 0.2s;
-        }}
-        .stButton>button:hover {{
+        }
+        .stButton>button:hover {
             transform: scale(1.05);
-            background-color: {button_hover};
-        }}
-        .stDownloadButton>button {{
+            background-color: #45a049;
+        }
+        .stDownloadButton>button {
             background-color: #008CBA !important;
-        }}
-        .highlight {{
+        }
+        .highlight {
             background-color: #ffff00;
             padding: 2px 4px;
             border-radius: 4px;
-        }}
+        }
         /* Header styling */
-        .header {{
+        .header {
             text-align: center;
             padding: 2rem 0;
-        }}
+        }
     </style>
 """
-st.markdown(custom_css, unsafe_allow_html=True)
+
+if dark_mode:
+    text_color = "#ffffff"
+    header_color = "#ecf0f1"
+else:
+    text_color = "#000000"
+    header_color = "#2c3e50"
+
+st.markdown(_CSS_DARK if dark_mode else _CSS_LIGHT, unsafe_allow_html=True)
 
 # ------------------------------
 # Header Section
@@ -349,6 +783,7 @@ st.markdown(f"""
 # Start the WebSocket client for real-time collaboration if a file is uploaded
 if uploaded_file:
     start_ws_client()
+    poll_collab_updates()
 
 # ------------------------------
 # Main Application Logic (with additional tabs for various functionalities)
@@ -357,13 +792,54 @@ if uploaded_file:
 if uploaded_file:
     with st.spinner("Processing document..."):
         start_time = time.time()
-        pdf_pages, success = extract_pdf_text(uploaded_file)
+        file_bytes = uploaded_file.getvalue()
+        doc_id = hashlib.sha1(file_bytes).hexdigest()
+        extraction = get_pdf_extraction(doc_id, file_bytes)
+        # Only wait for the first page; the rest keep extracting in the background
+        while not extraction["pages"] and not extraction["done"].is_set():
+            time.sleep(0.05)
         processing_time = time.time() - start_time
 
-    if not success:
+    if extraction["error"]:
+        st.error(f"PDF Error: {extraction['error']}")
         st.stop()
+    if extraction["rasterize_failed"]:
+        st.warning("OCR conversion failed; make sure Poppler is installed properly.")
+
+    # Keep the pages and derived text in session state, rebuilt only when a different document
+    # is uploaded or more pages have been extracted since the last rerun
+    if st.session_state.get("pdf_doc_id") != doc_id:
+        st.session_state.pdf_doc_id = doc_id
+        st.session_state.pdf_pages = ()
+        st.session_state.pdf_full_text = ""
+        st.session_state.pdf_pages_lower = ()
+        st.session_state.pdf_shared = False
+        st.session_state.current_page = 0
+    if extraction["full_text"] is not None:
+        # Finished: reference the extraction's shared copies instead of holding per-session ones
+        if not st.session_state.pdf_shared:
+            st.session_state.pdf_pages = tuple(extraction["pages"])
+            st.session_state.pdf_full_text = extraction["full_text"]
+            st.session_state.pdf_pages_lower = extraction["pages_lower"]
+            st.session_state.pdf_shared = True
+    elif len(extraction["pages"]) > len(st.session_state.pdf_pages):
+        # Only ever grow: an evicted extraction restarts from page 1 and must not truncate the session
+        pages = tuple(extraction["pages"])
+        # These pages come from a new extraction, so its shared copies must be picked up when it finishes
+        st.session_state.pdf_shared = False
+        st.session_state.pdf_pages = pages
+        st.session_state.pdf_full_text = "\n".join(pages)
+        st.session_state.pdf_pages_lower = tuple(page.lower() for page in pages)
+    pdf_pages = st.session_state.pdf_pages
+    st.session_state.current_page = min(st.session_state.current_page, max(len(pdf_pages) - 1, 0))
+    # Cache key for per-document results; includes the page count so partial results aren't reused
+    doc_key = f"{doc_id}:{len(pdf_pages)}"
 
-    st.success(f"Document processed in {processing_time:.2f} seconds.")
+    if extraction["done"].is_set() or len(pdf_pages) == extraction["page_count"]:
+        st.success(f"Document processed in {processing_time:.2f} seconds.")
+    else:
+        st.info(f"Extracted {len(pdf_pages)} of {extraction['page_count']} pages so far; "
+                "the rest will appear as you interact with the app.")
 
     # Create tabs including the new Quiz Generation tab
     tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
@@ -384,11 +860,11 @@ if uploaded_file:
         if "current_page" not in st.session_state:
             st.session_state.current_page = 0
         if "annotations" not in st.session_state:
-            st.session_state.annotations = {}  # Local annotations: {page index: list of annotation dicts}
+            st.session_state.annotations = {}  # Local annotations: {page index: {annotation_id: annotation dict}}
         if "revision_history" not in st.session_state:
             st.session_state.revision_history = {}  # {annotation_id: [list of revisions]}
         if "collab_annotations" not in st.session_state:
-            st.session_state.collab_annotations = []  # Collaborative annotations from other users
+            st.session_state.collab_annotations = {}  # Collaborative annotations from other users: {annotation_id: annotation dict}
 
         # Navigation Buttons
         nav_cols = st.columns([1, 2, 1])
@@ -414,11 +890,9 @@ if uploaded_file:
 
         if st.button("Generate Speech"):
             if page_text.strip():
-                audio_path = text_to_speech(page_text)
+                audio_bytes = text_to_speech(page_text)
                 
                 # Play the generated audio
-                with open(audio_path, "rb") as f:
-                    audio_bytes = f.read()
                 st.audio(audio_bytes, format="audio/mp3")
                 
                 st.success("✅ Speech generated successfully!")
@@ -445,8 +919,8 @@ if uploaded_file:
                 }
                 # Save locally
                 if page_index not in st.session_state.annotations:
-                    st.session_state.annotations[page_index] = []
-                st.session_state.annotations[page_index].append(annotation_data)
+                    st.session_state.annotations[page_index] = {}
+                st.session_state.annotations[page_index][annotation_data["id"]] = annotation_data
                 st.success("Annotation saved locally!")
                 
                 # Record revision history (initial revision)
@@ -454,9 +928,7 @@ if uploaded_file:
                 
                 # Send the annotation to the WebSocket server for collaboration
                 try:
-                    ws = websocket.create_connection(WS_SERVER_URL)
-                    ws.send(json.dumps(annotation_data))
-                    ws.close()
+                    send_ws_message(annotation_data)
                 except Exception as e:
                     st.error(f"Failed to send annotation to collaboration server: {e}")
             else:
@@ -466,7 +938,7 @@ if uploaded_file:
         page_index = st.session_state.current_page
         if page_index in st.session_state.annotations and st.session_state.annotations[page_index]:
             st.markdown("#### Your Annotations for this Page:")
-            for ann in st.session_state.annotations[page_index]:
+            for ann in st.session_state.annotations[page_index].values():
                 st.markdown(f"**Annotation by {ann['user']} on Page {ann['page']}:**")
                 st.markdown(f"- **Selected Text:** {ann['selected_text']}")
                 st.markdown(f"- **Annotation:** {ann['annotation']}")
@@ -483,7 +955,7 @@ if uploaded_file:
         # Display Collaborative Annotations received from other users
         st.markdown("### Collaborative Annotations from Other Users")
         if st.session_state.collab_annotations:
-            for ann in st.session_state.collab_annotations:
+            for ann in list(st.session_state.collab_annotations.values()):  # Snapshot; the event loop may add entries
                 st.markdown(f"**From {ann.get('user', 'Unknown')} on Page {ann.get('page')}:**")
                 st.markdown(f"- **Selected Text:** {ann.get('selected_text')}")
                 st.markdown(f"- **Annotation:** {ann.get('annotation')}")
@@ -495,24 +967,18 @@ if uploaded_file:
         st.subheader("Document Search Engine")
         search_term = st.text_input("Enter search keywords:", "")
         if search_term.strip():
-            matches = []
-            pattern = re.compile(re.escape(search_term), re.IGNORECASE)
-            for page_num, text in enumerate(pdf_pages):
-                for match in pattern.finditer(text):
-                    # Extract context around the match (up to 100 characters on either side)
-                    start_context = max(0, match.start() - 100)
-                    end_context = min(len(text), match.end() + 100)
-                    context = text[start_context:end_context]
-                    # Highlight the match within the context
-                    highlighted = pattern.sub(r'<span class="highlight">\g<0></span>', context)
-                    matches.append((page_num + 1, highlighted))
+            matches = run_search(doc_key, pdf_pages, st.session_state.pdf_pages_lower, search_term)
             
             if matches:
                 st.success(f"Found {len(matches)} match(es):")
                 # Loop through each match and allow annotation
-                for idx, (page, context) in enumerate(matches):
+                for idx, (page, context, match_start, match_end) in enumerate(matches):
+                    # Highlight the match within the context
+                    highlighted = (context[:match_start]
+                                   + f'<span class="highlight">{context[match_start:match_end]}</span>'
+                                   + context[match_end:])
                     with st.container():
-                        st.markdown(f"**Page {page}:** {context}", unsafe_allow_html=True)
+                        st.markdown(f"**Page {page}:** {highlighted}", unsafe_allow_html=True)
                         annotate_toggle = st.checkbox("Add Annotation", key=f"annotate_toggle_{idx}")
                         if annotate_toggle:
                             if f"annotation_{idx}" not in st.session_state:
@@ -555,11 +1021,9 @@ if uploaded_file:
             tts_text = st.text_area("Enter text to speak:", height=150)
             if st.button("Generate Speech",key=456):
                 if tts_text.strip():
-                    audio_path = text_to_speech(tts_text)
+                    audio_bytes = text_to_speech(tts_text)
                     
                     # Play the generated audio
-                    with open(audio_path, "rb") as f:
-                        audio_bytes = f.read()
                     st.audio(audio_bytes, format="audio/mp3")
                     
                     st.success("✅ Speech generated successfully!")
@@ -576,13 +1040,11 @@ if uploaded_file:
         # Option to select between summarizing the entire document or a single page.
         summary_option = st.radio("Summarize:", ("Entire Document", "Current Page"), index=1)
         if summary_option == "Entire Document":
-            # Concatenate all pages (you might want to limit the length if the PDF is very large)
-            full_text = "\n".join(pdf_pages)
+            # Summarize chunks of pages in parallel, then stream the combined summary
             if st.button("Summarize Entire Document"):
-                with st.spinner("Summarizing entire document..."):
-                    summary = summarize_text(full_text)
                 st.markdown("#### Summary:")
-                st.write(summary)
+                with st.spinner("Summarizing entire document..."):
+                    summarize_document(doc_key, pdf_pages)
         else:
             # Summarize only the current page
             current_text = pdf_pages[st.session_state.current_page]
@@ -626,9 +1088,7 @@ if uploaded_file:
                 st.session_state.collab_chat.append(chat_data)
                 # Send the chat message to the WebSocket server
                 try:
-                    ws = websocket.create_connection(WS_SERVER_URL)
-                    ws.send(json.dumps(chat_data))
-                    ws.close()
+                    send_ws_message(chat_data)
                 except Exception as e:
                     st.error(f"Failed to send chat message to collaboration server: {e}")
                 st.rerun()  # Update the UI
@@ -663,7 +1123,7 @@ if uploaded_file:
         if st.button("Generate Quiz"):
             with st.spinner("Generating quiz..."):
                 if quiz_option == "Entire Document":
-                    text_for_quiz = "\n".join(pdf_pages)
+                    text_for_quiz = st.session_state.pdf_full_text
                 else:
                     text_for_quiz = pdf_pages[st.session_state.current_page]
                 quiz = generate_quiz(text_for_quiz, num_questions=num_questions)
@@ -11,8 +11,16 @@ async def handler(websocket, path):
     print("New client connected")
     try:
         async for message in websocket:
-            # Broadcast the received annotation to all other clients
-            print("Received message:", message)
+            # Clients coalesce messages into {"batch": [...]} frames; unpack for logging only,
+            # so an unexpected payload shape never stops the frame from being relayed
+            try:
+                data = json.loads(message)
+                items = list(data.get("batch", [data]))
+            except (ValueError, AttributeError, TypeError):
+                items = [message]
+            for item in items:
+                print("Received message:", item)
+            # Broadcast the received frame to all other clients as-is
             for client in clients:
                 if client != websocket:
                     await client.send(message)